@@ -1,21 +1,102 @@
 from asyncio.subprocess import Process
 from asyncio import Task
+from types import ModuleType
+from collections import deque
+from functools import cache
 from typing import Callable, Optional, TYPE_CHECKING
 from loguru import logger
-from qemu.qmp import QMPClient
+from qemu.qmp import EventListener, QMPClient
 
 import subprocess
 import platform
+import tempfile
 import asyncio
 import shutil
-import lldb
 import os
+import re
 
-from securebootfuzzer.Utils import random_str, find_available_port
+from securebootfuzzer.Utils import find_available_port
 from securebootfuzzer.Machine.CpuArchitecture import CpuArchitectureType, get_qemu_binary, get_cpu_enum
 
+if TYPE_CHECKING:
+    import lldb
+
 host_cpu_architecture = get_cpu_enum(platform.machine())
 
+# QEMU stderr lines matching this are treated as a health degradation
+_ANOMALY_RE = re.compile(rb"(?i)cannot set up|error|invalid")
+_STDERR_CHUNK_SIZE = 64 * 1024
+
+def _split_lines(pending: bytearray, final: bool) -> list[bytes]:
+    """
+    Pops the complete lines off `pending`. An unterminated line reaching `_STDERR_CHUNK_SIZE` is split
+    so the buffer stays bounded, and the trailing partial line is popped too when `final` is set.
+    """
+    lines: list[bytes] = []
+    start = 0
+    while True:
+        end = pending.find(b"\n", start)
+        if end >= 0:
+            lines.append(bytes(pending[start:end]))
+            start = end + 1
+        elif len(pending) - start >= _STDERR_CHUNK_SIZE:
+            lines.append(bytes(pending[start:start + _STDERR_CHUNK_SIZE]))
+            start += _STDERR_CHUNK_SIZE
+        else:
+            break
+
+    if final and start < len(pending):
+        lines.append(bytes(pending[start:]))
+        start = len(pending)
+
+    del pending[:start]
+    return lines
+
+@cache
+def _resolve_qemu(cpu_arch: CpuArchitectureType) -> str:
+    # Walking PATH once per architecture is enough, no matter how many guests we spawn
+    binary = get_qemu_binary(cpu_arch)
+    path = shutil.which(binary)
+    if not path:
+        logger.critical("`{}` not found in PATH. Required to create guests VMs.", binary)
+        exit(1)
+
+    return path
+
+def _lldb() -> ModuleType:
+    # LLDB is heavy to import, so only load it once a guest actually attaches a debugger
+    global lldb
+    import lldb
+    return lldb
+
+_debugger: Optional["lldb.SBDebugger"] = None
+
+def _get_debugger() -> "lldb.SBDebugger":
+    # A single debugger instance is shared by all guests; each one only owns its target
+    global _debugger
+    if _debugger is None:
+        _debugger = _lldb().SBDebugger.Create()
+        _debugger.SetAsync(True)
+
+    return _debugger
+
+# QEMU arguments shared by every guest, regardless of its configuration
+_STATIC_QEMU_ARGS = (
+    "-net", # Disable networking
+    "none",
+
+    "-smp", # UEFI only brings up BSP (unicore), so additional cores are useless
+    "1",
+
+    "-chardev", # define output
+    "stdio,id=char0,signal=off",
+
+    "-serial", # redirect serial logs to output
+    "chardev:char0",
+
+    "-S", # Halt CPU on reset vector
+)
+
 class VirtualMachine:
     """
     QEMU virtual machine abstraction class
@@ -36,29 +117,27 @@ class VirtualMachine:
 
         on_anomaly_callback: Callable[[], None],
         on_health_degradation_callback: Callable[[], None],
+        on_shutdown_callback: Callable[[], None],
     ) -> None:
         if kvm_enabled and host_cpu_architecture != vm_cpu_architecture:
             # What did you expect
-            raise ValueError(f"KVM cannot be enabled because guest would be {vm_cpu_architecture} while host is {host_cpu_architecture}")
+            raise ValueError(f"KVM cannot be enabled because guest would be {vm_cpu_architecture.name} while host is {host_cpu_architecture.name}")
 
-        if not shutil.which(get_qemu_binary(vm_cpu_architecture)):
-            logger.critical(
-                "`{}` not found in PATH. Required to create guests VMs.",
-                get_qemu_binary(vm_cpu_architecture)
-            )
-            exit(1)
+        self.qemu_binary_path: str = _resolve_qemu(vm_cpu_architecture)
 
         self.job_counter: int = 0
+        self._job_listeners: dict[str, EventListener] = {} # in-flight jobs, by job ID
         self.on_anomaly_callback: Callable[[], None] = on_anomaly_callback
         self.on_health_degradation_callback: Callable[[], None] = on_health_degradation_callback
+        self.on_shutdown_callback: Callable[[], None] = on_shutdown_callback
 
         self.gdb_port: int = 0
-        self.qmp_sock_name: str = f"qmp_{random_str(16)}_fuzz.sock"
+        self.qmp_sock_dir: str | None = None # private per guest, created on start
 
         self._health_monitor: Task | None = None
+        self._shut_down: asyncio.Event = asyncio.Event() # wakes up anything waiting on the guest once it's gone
         self.qemu_process: Process | None = None
-        self.debugger: lldb.SBDebugger = lldb.SBDebugger.Create()
-        self.debugger.SetAsync(True)
+        self.debugger_target: lldb.SBTarget | None = None
 
         self.qmp_client: QMPClient = QMPClient()
         self.ovmf_process: lldb.SBProcess | None = None
@@ -81,7 +160,7 @@ class VirtualMachine:
         process = await asyncio.create_subprocess_exec(
             "qemu-img",
             "create", "-f", "qcow2", f"{self.vm_root_dir}/vmstate.qcow2", "16M",
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE
         )
 
@@ -91,10 +170,13 @@ class VirtualMachine:
             raise RuntimeError(f"`qemu-img` failed: {await process.stderr.read()}")
 
     async def _init_debugger(self) -> None:
-        target: lldb.SBTarget = self.debugger.CreateTarget(None)
-        error = lldb.SBError()
+        debugger = _get_debugger()
+        target: lldb.SBTarget = debugger.CreateTarget(None)
+        self.debugger_target = target
+
+        error = _lldb().SBError()
         process: lldb.SBProcess = target.ConnectRemote(
-            self.debugger.GetListener(),
+            debugger.GetListener(),
             f"connect://localhost:{self.gdb_port}",
             None,
             error
@@ -113,82 +195,130 @@ class VirtualMachine:
             assert qemu_process.stderr # Pyright
 
         logger.info("Monitoring guest VM health...")
-        lines: list[str] = []
+        lines: deque[bytes] = deque(maxlen=512) # only the most recent output is useful in a crash report
+        pending = bytearray()
 
         # (not so) evil polling incoming
         while True:
-            line = await qemu_process.stderr.readline()
-            message = line.decode()
-            if message == "": # QEMU was closed
-                await self.shutdown()
-                break
+            # Drain whatever QEMU has written so far and split it locally, rather than waking up per line
+            chunk = await qemu_process.stderr.read(_STDERR_CHUNK_SIZE)
+            pending += chunk
 
-            lines.append(message)
-            if (
-                "cannot set up" in message.lower()
-                or "error" in message.lower()
-                or "invalid" in message.lower()
-                or (qemu_process.returncode and qemu_process.returncode != 0)
-            ):
-                logger.error(
-                    "QEMU reported an error. Logs:\n{}",
-                    '\n'.join(lines)
-                )
+            for line in _split_lines(pending, final=chunk == b""):
+                lines.append(line)
+                if _ANOMALY_RE.search(line) or qemu_process.returncode not in (None, 0):
+                    logger.error(
+                        "QEMU reported an error. Logs:\n{}",
+                        b'\n'.join(lines).decode(errors="replace")
+                    )
 
-                logger.trace("Calling health callback")
-                self.on_health_degradation_callback()
+                    logger.trace("Calling health callback")
+                    self.on_health_degradation_callback()
+
+                    if TYPE_CHECKING:
+                        assert self.qemu_process # Pyright
+
+                    await self.shutdown()
+                    return
 
-                if TYPE_CHECKING:
-                    assert self.qemu_process # Pyright
+                logger.opt(lazy=True).trace("{}", lambda: line.decode(errors="replace")) # only decoded if TRACE is enabled
 
+            if chunk == b"": # QEMU was closed
                 await self.shutdown()
                 break
 
-            logger.trace(message)
+    async def _start_job(self, command: str, arguments: dict, kind: str) -> str:
+        self.job_counter += 1
+        job_id = f"sbf-{kind}-{self.job_counter}"
 
-    async def _wait_job(self, job_id: str) -> None:
-        assert self.qemu_process
-        while True:
+        # Listen before issuing the command, otherwise a fast job may conclude before we subscribe
+        listener = EventListener("JOB_STATUS_CHANGE")
+        self.qmp_client.register_listener(listener)
+        try:
+            logger.trace(await self.qmp_client.execute(command, {"job-id": job_id, **arguments}))
+        except:
+            self.qmp_client.remove_listener(listener)
+            raise
+
+        self._job_listeners[job_id] = listener
+        return job_id
+
+    async def _follow_job(self, listener: EventListener, job_id: str) -> tuple[str, bool]:
+        status = ""
+        aborted = False
+        async for event in listener:
+            data = event["data"]
+            if data["id"] != job_id:
+                continue
+
+            status = data["status"]
+            logger.trace("Job '{}': {}", job_id, status)
+            if status == "aborting": # failed jobs go through here before concluding
+                aborted = True
+            elif status in ("concluded", "null"):
+                break
+
+        return status, aborted
+
+    async def wait_job(self, job_id: str) -> None:
+        listener = self._job_listeners.pop(job_id)
+        if not self.qemu_process:
+            self.qmp_client.remove_listener(listener)
+            raise RuntimeError(f"Guest was shut down before waiting for job '{job_id}'")
+
+        # The listener never ends on its own, so give up on the job if the guest goes away meanwhile
+        follow = asyncio.ensure_future(self._follow_job(listener, job_id))
+        shut_down = asyncio.ensure_future(self._shut_down.wait())
+        try:
+            await asyncio.wait((follow, shut_down), return_when=asyncio.FIRST_COMPLETED)
+            followed = follow.done()
+        finally:
+            follow.cancel()
+            shut_down.cancel()
+            self.qmp_client.remove_listener(listener)
+
+        if not followed:
+            raise RuntimeError(f"Guest was shut down while waiting for job '{job_id}'")
+
+        status, aborted = follow.result()
+        if status == "null": # already dismissed, nothing left to inspect
+            if aborted:
+                raise RuntimeError(f"Job '{job_id}' failed")
+            return
+
+        # Only a failed job needs a `query-jobs` round-trip, to fetch its error message
+        error = None
+        if aborted:
             jobs: list = await self.qmp_client.execute("query-jobs") # pyright: ignore[reportAssignmentType]
+            error = next((job for job in jobs if job["id"] == job_id), f"Job '{job_id}' failed")
 
-            for job in jobs:
-                if job["id"] == job_id:
-                    if job["status"] == "concluded":
-                        logger.trace("Job '{}': {}", job_id, job)
-                        return
-                    if job["status"] in ("failed", "aborted", "error"):
-                        raise RuntimeError(job)
-            #await asyncio.sleep(0.05)
+        await self.qmp_client.execute("job-dismiss", {"id": job_id})
+        if aborted:
+            raise RuntimeError(error)
 
-    async def save_snapshot(self, name: str) -> None:
+    async def save_snapshot_start(self, name: str) -> str:
         assert self.qemu_process
-        self.job_counter += 1
-        job_id = f"sbf-save_snapshot-{self.job_counter}"
-
         logger.trace(f"Creating snapshot '{name}'")
-        logger.trace(await self.qmp_client.execute("snapshot-save", {
-            "job-id": job_id,
+        return await self._start_job("snapshot-save", {
             "tag": name,
             "vmstate": "vmstate_drive",
             "devices": ["vmstate_drive"]
-        }))
+        }, "save_snapshot")
 
-        await self._wait_job(job_id)
+    async def save_snapshot(self, name: str) -> None:
+        await self.wait_job(await self.save_snapshot_start(name))
 
-    async def load_snapshot(self, name: str) -> None:
+    async def load_snapshot_start(self, name: str) -> str:
         assert self.qemu_process
-        self.job_counter += 1
-        job_id = f"sbf-load_snapshot-{self.job_counter}"
-
         logger.trace(f"Loading snapshot '{name}'")
-        logger.trace(await self.qmp_client.execute("snapshot-load", {
-            "job-id": job_id,
+        return await self._start_job("snapshot-load", {
             "tag": name,
             "vmstate": "vmstate_drive",
             "devices": ["vmstate_drive"]
-        }))
+        }, "load_snapshot")
 
-        await self._wait_job(job_id)
+    async def load_snapshot(self, name: str) -> None:
+        await self.wait_job(await self.load_snapshot_start(name))
 
     async def resume(self) -> None:
         assert self.qemu_process and self.ovmf_process
@@ -209,31 +339,21 @@ class VirtualMachine:
         await self.qmp_client.execute("system_reset")
 
     async def start(self):
+        self._shut_down.clear()
         await self._create_qcow2_vmstate_disk()
+        self.qmp_sock_dir = tempfile.mkdtemp(prefix="sbf-qmp-")
+        qmp_sock_name = f"{self.qmp_sock_dir}/qmp.sock"
 
-        available_gdb_port = find_available_port()
-        assert available_gdb_port
-        self.gdb_port = available_gdb_port
+        self.gdb_port = find_available_port()
 
         args = [
-            "-net", # Disable networking
-            "none",
-
-            "-smp", # UEFI only brings up BSP (unicore), so additional cores are useless
-            "1",
-
-            "-chardev", # define output
-            "stdio,id=char0,signal=off",
+            *_STATIC_QEMU_ARGS,
 
-            "-serial", # redirect serial logs to output
-            "chardev:char0",
-
-            "-S", # Halt CPU on reset vector
             "-gdb", # We don't use the -s shorthand, because port would obviously be busy.
-            f"tcp::{available_gdb_port}",
+            f"tcp::{self.gdb_port}",
 
             "-qmp",
-            f"unix:{self.qmp_sock_name},server=on,wait=on", # Here we instruct QEMU to set up the QMP server at the specified socket
+            f"unix:{qmp_sock_name},server=on,wait=on", # Here we instruct QEMU to set up the QMP server at the specified socket
 
             "-m",
             f"{self.memory_size_mb}M", # self explainatory... isn't it?
@@ -268,38 +388,45 @@ class VirtualMachine:
         if self.kvm_enabled:
             args.append("-enable-kvm")
         else:
-            args.append("-accel tcg")
+            args += ("-accel", "tcg")
 
         if self.fw_vars_path:
-            args.append(f"-drive if=pflash,format=raw,file={self.fw_vars_path}") # UEFI vars (NVRAM)
+            args += ("-drive", f"if=pflash,format=raw,file={self.fw_vars_path}") # UEFI vars (NVRAM)
 
-        binary = get_qemu_binary(self.cpu_architecture)
-        logger.trace("Command: {} {}", binary, ' '.join(args))
+        logger.trace("Command: {} {}", self.qemu_binary_path, ' '.join(args))
         self.qemu_process = await asyncio.create_subprocess_exec(
-            binary,
+            self.qemu_binary_path,
             *args,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE
         )
 
         self._health_monitor = asyncio.create_task(self._health_monitor_proc())
         logger.debug("Installed health monitor")
 
-        for i in range(3):
+        # QEMU usually has the QMP socket up within milliseconds, so retry fast and back off from there
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 5.0
+        delay = 0.025
+        while True:
             try:
-                await self.qmp_client.connect(self.qmp_sock_name)
+                await self.qmp_client.connect(qmp_sock_name)
                 break
-            except:
-                if i != 4:
-                    logger.warning("Couldn't connect to QMP server; waiting for 1 second")
-                    await asyncio.sleep(1)
-                    continue
-
-                logger.exception("An error occured while connecting to the QMP server")
-                if self.qemu_process:
-                    await self.shutdown()
+            except Exception:
+                if not self.qemu_process: # QEMU already exited and the health monitor shut the guest down
+                    logger.error("QEMU exited before its QMP server came up")
+                    return
 
-                return
+                if loop.time() + delay >= deadline:
+                    logger.exception("An error occured while connecting to the QMP server")
+                    if self.qemu_process:
+                        await self.shutdown()
+
+                    return
+
+                logger.debug("Couldn't connect to QMP server; retrying in {}ms", int(delay * 1000))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
 
         await self._init_debugger()
         logger.debug("Debugger attached to GDB remote")
@@ -313,7 +440,10 @@ class VirtualMachine:
         logger.debug("Disconnecting from GDB remote")
         if self.ovmf_process:
             self.ovmf_process.Clear()
-        self.debugger.Clear()
+            self.ovmf_process = None
+        if self.debugger_target:
+            _get_debugger().DeleteTarget(self.debugger_target)
+            self.debugger_target = None
 
         logger.debug("Uninstalling health monitor")
         self._health_monitor.cancel()
@@ -322,6 +452,10 @@ class VirtualMachine:
         logger.debug("Shutting down guest")
         self.qemu_process.kill()
         self.qemu_process = None
+        self._shut_down.set()
+
+        logger.trace("Calling shutdown callback")
+        self.on_shutdown_callback() # before any await: the health monitor may be the one shutting us down
 
         logger.debug("Disconnecting from QMP server")
         try:
@@ -330,8 +464,9 @@ class VirtualMachine:
         except:
             logger.exception("Couldn't disconnect from QMP server (this may be expected; check previous logs)")
 
-        if os.path.exists(self.qmp_sock_name):
-            os.remove(self.qmp_sock_name)
+        if self.qmp_sock_dir:
+            shutil.rmtree(self.qmp_sock_dir, ignore_errors=True)
+            self.qmp_sock_dir = None
 
         logger.debug("Removing vmstate.qcow2 disk")
         if os.path.exists(f"{self.vm_root_dir}/vmstate.qcow2"):
@@ -1,17 +1,8 @@
-import string
-import random
 import socket
 
-def random_str(N: int) -> str:
-    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(N))
-
-def find_available_port(start: int = 8000, end: int = 9999) -> int | None:
-    for port in range(start, end + 1):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.bind(('localhost', port))
-                return port
-            except socket.error:
-                continue
-
-    return None
+def find_available_port() -> int:
+    # Let the kernel hand us a free ephemeral port instead of probing a range one bind at a time
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
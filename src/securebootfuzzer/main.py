@@ -1,3 +1,4 @@
+from argparse import Namespace
 from loguru import logger
 
 import asyncio
@@ -5,27 +6,13 @@ import shutil
 import sys
 import os
 
-sys.path.append("/usr/lib/python3.14/site-packages") # enables LLDB import
-
-from securebootfuzzer.Machine.VirtualMachine import VirtualMachine, CpuArchitectureType, get_cpu_enum
-from securebootfuzzer.CliParser import parser
-
-def prune_dead_guests(guests: list[VirtualMachine]) -> list[VirtualMachine]:
-    guests[:] = [
-        guest
-        for guest in guests
-        if guest.qemu_process is not None
-        and guest.qemu_process.returncode is None
-    ]
-
-    return guests
+from securebootfuzzer.CliParser import build_parser
 
 def stub():
     return
 
 @logger.catch
-async def main() -> None:
-    args = parser.parse_args()
+async def main(args: Namespace) -> None:
     debug_level = args.debug_level.upper()
 
     logger.remove(0)
@@ -36,16 +23,23 @@ async def main() -> None:
         level=debug_level
     )
 
-    vm_cpu_architecture = get_cpu_enum(args.vm_cpu_architecture)
+    # Deferred until arguments are parsed so `--help` and usage errors don't pay for LLDB and QMP imports
+    sys.path.append("/usr/lib/python3.14/site-packages") # enables LLDB import
+    from securebootfuzzer.Machine.VirtualMachine import VirtualMachine
+
+    vm_cpu_architecture = args.vm_cpu_architecture
 
     logger.info("Tianofaux says Bonjour!")
-    logger.info("Will be fuzzing UEFI firmware '{}' for architecture '{}'", args.fw_binary_path, vm_cpu_architecture)
+    logger.info("Will be fuzzing UEFI firmware '{}' for architecture '{}'", args.fw_binary_path, vm_cpu_architecture.name)
+
+    os.makedirs(args.storage_path, exist_ok=True)
 
-    # bring up
-    guests: list[VirtualMachine] = []
-    for i in range(args.concurrent_vms):
+    # Guests drop themselves from here through their shutdown callback, whatever shut them down
+    live_guests: set[VirtualMachine] = set()
+
+    def create_guest(i: int) -> VirtualMachine:
         vm_root_dir = f"{args.storage_path}/vm_{i}"
-        os.mkdir(vm_root_dir)
+        os.makedirs(vm_root_dir, exist_ok=True) # may be left over from a previous, crashed run
 
         guest = VirtualMachine(
             vm_cpu_architecture,
@@ -57,27 +51,73 @@ async def main() -> None:
             args.fw_symbols_path,
             args.fw_source_path,
             on_health_degradation_callback=stub,
-            on_anomaly_callback=stub
+            on_anomaly_callback=stub,
+            on_shutdown_callback=lambda: live_guests.discard(guest)
         )
 
-        guests.append(guest)
+        live_guests.add(guest)
+        return guest
+
+    async def bring_up(guest: VirtualMachine) -> None:
         await guest.start()
+        if not guest.qemu_process: # start() failed, and already logged why
+            return
+
         await guest.save_snapshot("reset_vector") # CPU is disabled at this instant. We are at the reset vector.
         await guest.resume()
 
+    async def drop_guest(guest: VirtualMachine, error: BaseException) -> None:
+        # One failing guest must not take the others down with it
+        logger.opt(exception=error).error("Guest '{}' failed; dropping it", guest.vm_root_dir)
+        if guest.qemu_process:
+            await guest.shutdown()
+        live_guests.discard(guest) # in case it never got as far as launching QEMU
+
+    # bring up all guests concurrently
+    all_guests = [create_guest(i) for i in range(args.concurrent_vms)]
+    results = await asyncio.gather(*(bring_up(guest) for guest in all_guests), return_exceptions=True)
+    for guest, result in zip(all_guests, results):
+        if isinstance(result, BaseException):
+            await drop_guest(guest, result)
+
     logger.debug("Testing loading reset vector snapshot")
 
     for i in range(5):
         logger.debug("Testing iter {}", i)
-        for guest in prune_dead_guests(guests):
-            await guest.load_snapshot("reset_vector")
+        # Issue every load first, then reap the completions, so QMP round-trips overlap across guests
+        guests = list(live_guests)
+        job_ids = await asyncio.gather(
+            *(guest.load_snapshot_start("reset_vector") for guest in guests),
+            return_exceptions=True
+        )
+
+        started: list[tuple[VirtualMachine, str]] = []
+        for guest, job_id in zip(guests, job_ids):
+            if isinstance(job_id, BaseException):
+                await drop_guest(guest, job_id)
+            else:
+                started.append((guest, job_id))
+
+        results = await asyncio.gather(
+            *(guest.wait_job(job_id) for guest, job_id in started),
+            return_exceptions=True
+        )
+
+        for (guest, _), result in zip(started, results):
+            if isinstance(result, BaseException):
+                await drop_guest(guest, result)
+
         await asyncio.sleep(1)
 
     logger.debug("Shutting down all guests")
 
-    for guest in prune_dead_guests(guests):
-        await guest.shutdown()
-        shutil.rmtree(guest.vm_root_dir)
+    for guest in list(live_guests):
+        if guest.qemu_process: # may have died since the last iteration
+            await guest.shutdown()
+
+    for guest in all_guests: # dropped guests too
+        shutil.rmtree(guest.vm_root_dir, ignore_errors=True)
 
 def sync_main() -> None:
-    asyncio.run(main())
+    args = build_parser().parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,22 @@
+import pytest
+
+from securebootfuzzer.CliParser import build_parser
+from securebootfuzzer.Machine.CpuArchitecture import CpuArchitectureType
+
+def test_architecture_defaults_to_x86_64():
+    args = build_parser().parse_args(["-b", "OVMF.fd"])
+    assert args.vm_cpu_architecture is CpuArchitectureType.X86_64
+
+def test_architecture_is_converted_while_parsing():
+    args = build_parser().parse_args(["-b", "OVMF.fd", "-a", "aarch64"])
+    assert args.vm_cpu_architecture is CpuArchitectureType.AARCH64
+
+    args = build_parser().parse_args(["-b", "OVMF.fd", "--architecture", "i686"])
+    assert args.vm_cpu_architecture is CpuArchitectureType.X86_32
+
+def test_unknown_architecture_is_a_usage_error(capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        build_parser().parse_args(["-b", "OVMF.fd", "-a", "mips"])
+
+    assert excinfo.value.code == 2
+    assert "argument -a/--architecture: CPU type 'mips' is either invalid or not supported by EDK-II" in capsys.readouterr().err
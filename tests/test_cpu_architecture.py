@@ -0,0 +1,28 @@
+import pytest
+
+from securebootfuzzer.Machine.CpuArchitecture import CpuArchitectureType, machine_mapping, get_cpu_enum, get_qemu_binary
+
+def test_get_cpu_enum_resolves_aliases():
+    assert get_cpu_enum("x86_64") is CpuArchitectureType.X86_64
+    assert get_cpu_enum("amd64") is CpuArchitectureType.X86_64
+    assert get_cpu_enum("i686") is CpuArchitectureType.X86_32
+
+def test_get_cpu_enum_rejects_unknown_architecture():
+    with pytest.raises(ValueError, match="'mips'"):
+        get_cpu_enum("mips")
+
+@pytest.mark.parametrize("cpu_arch, binary", [
+    (CpuArchitectureType.X86_32, "qemu-system-i386"),
+    (CpuArchitectureType.X86_64, "qemu-system-x86_64"),
+    (CpuArchitectureType.AARCH64, "qemu-system-aarch64"),
+    (CpuArchitectureType.RISC_V_32, "qemu-system-riscv32"),
+    (CpuArchitectureType.RISC_V_64, "qemu-system-riscv64"),
+    (CpuArchitectureType.POWERPC_32, "qemu-system-ppc"),
+    (CpuArchitectureType.POWERPC_64, "qemu-system-ppc64"),
+])
+def test_get_qemu_binary(cpu_arch, binary):
+    assert get_qemu_binary(cpu_arch) == binary
+
+def test_every_mapped_architecture_has_a_qemu_binary():
+    for cpu_arch in machine_mapping.values():
+        assert get_qemu_binary(cpu_arch).startswith("qemu-system-")
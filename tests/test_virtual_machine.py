@@ -0,0 +1,224 @@
+from types import SimpleNamespace
+from loguru import logger
+
+import asyncio
+import pytest
+
+from securebootfuzzer.Machine.VirtualMachine import VirtualMachine, _split_lines, _STDERR_CHUNK_SIZE
+
+class FakeQMPClient:
+    def __init__(self, jobs: list | None = None) -> None:
+        self.jobs = jobs or []
+        self.executed: list[str] = []
+        self.listeners: list = []
+
+    def register_listener(self, listener) -> None:
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener) -> None:
+        listener.clear()
+        self.listeners.remove(listener)
+
+    async def execute(self, command: str, arguments: dict | None = None):
+        self.executed.append(command)
+        if command == "query-jobs":
+            return self.jobs
+        return {}
+
+    async def disconnect(self) -> None:
+        pass
+
+    async def emit_job_status(self, job_id: str, status: str) -> None:
+        for listener in self.listeners:
+            await listener.put({"event": "JOB_STATUS_CHANGE", "data": {"id": job_id, "status": status}})
+
+def make_guest(qmp_client: FakeQMPClient | None = None) -> VirtualMachine:
+    # Skip __init__, which looks for QEMU in PATH
+    guest = VirtualMachine.__new__(VirtualMachine)
+    guest.job_counter = 0
+    guest._job_listeners = {}
+    guest._shut_down = asyncio.Event()
+    guest.qemu_process = object() # pyright: ignore[reportAttributeAccessIssue]
+    guest.qmp_client = qmp_client or FakeQMPClient() # pyright: ignore[reportAttributeAccessIssue]
+    return guest
+
+async def start_job(guest: VirtualMachine, *statuses: str) -> str:
+    job_id = await guest.load_snapshot_start("reset_vector")
+    for status in statuses:
+        await guest.qmp_client.emit_job_status(job_id, status) # pyright: ignore[reportAttributeAccessIssue]
+    return job_id
+
+def test_wait_job_success_only_dismisses():
+    async def run():
+        qmp_client = FakeQMPClient()
+        guest = make_guest(qmp_client)
+        job_id = await start_job(guest, "created", "running", "concluded")
+        await guest.wait_job(job_id)
+        return qmp_client
+
+    qmp_client = asyncio.run(run())
+    assert qmp_client.executed == ["snapshot-load", "job-dismiss"]
+    assert qmp_client.listeners == []
+
+def test_wait_job_ignores_other_jobs():
+    async def run():
+        qmp_client = FakeQMPClient()
+        guest = make_guest(qmp_client)
+        job_id = await start_job(guest)
+        await qmp_client.emit_job_status("sbf-other-42", "concluded")
+        await qmp_client.emit_job_status(job_id, "concluded")
+        await guest.wait_job(job_id)
+        return qmp_client
+
+    assert asyncio.run(run()).executed == ["snapshot-load", "job-dismiss"]
+
+def test_wait_job_gives_up_when_guest_shuts_down():
+    async def run():
+        qmp_client = FakeQMPClient()
+        guest = make_guest(qmp_client)
+        job_id = await start_job(guest, "running")
+        waiter = asyncio.create_task(guest.wait_job(job_id))
+        await asyncio.sleep(0)
+        guest._shut_down.set()
+        with pytest.raises(RuntimeError, match="shut down"):
+            await asyncio.wait_for(waiter, 1)
+        return qmp_client
+
+    assert asyncio.run(run()).listeners == []
+
+def test_wait_job_on_dead_guest_removes_listener():
+    async def run():
+        qmp_client = FakeQMPClient()
+        guest = make_guest(qmp_client)
+        job_id = await start_job(guest)
+        guest.qemu_process = None
+        with pytest.raises(RuntimeError, match="shut down"):
+            await guest.wait_job(job_id)
+        return guest, qmp_client
+
+    guest, qmp_client = asyncio.run(run())
+    assert qmp_client.listeners == []
+    assert guest._job_listeners == {}
+
+def test_wait_job_aborted_job_fetches_error_and_raises():
+    async def run():
+        qmp_client = FakeQMPClient([{"id": "sbf-load_snapshot-1", "status": "concluded", "error": "Snapshot not found"}])
+        guest = make_guest(qmp_client)
+        job_id = await start_job(guest, "running", "aborting", "concluded")
+        with pytest.raises(RuntimeError, match="Snapshot not found"):
+            await guest.wait_job(job_id)
+        return qmp_client
+
+    qmp_client = asyncio.run(run())
+    assert qmp_client.executed == ["snapshot-load", "query-jobs", "job-dismiss"]
+    assert qmp_client.listeners == []
+
+def test_wait_job_already_dismissed():
+    async def run():
+        qmp_client = FakeQMPClient()
+        guest = make_guest(qmp_client)
+        job_id = await start_job(guest, "null")
+        await guest.wait_job(job_id)
+
+        job_id = await start_job(guest, "aborting", "null")
+        with pytest.raises(RuntimeError, match="failed"):
+            await guest.wait_job(job_id)
+        return qmp_client
+
+    assert asyncio.run(run()).executed == ["snapshot-load", "snapshot-load"]
+
+def test_shutdown_notifies_owner(tmp_path):
+    shutdown_callbacks = 0
+
+    async def run():
+        nonlocal shutdown_callbacks
+        guest = make_guest()
+        guest.qemu_process = SimpleNamespace(kill=lambda: None) # pyright: ignore[reportAttributeAccessIssue]
+        guest._health_monitor = asyncio.create_task(asyncio.sleep(60))
+        guest.ovmf_process = None
+        guest.debugger_target = None
+        guest.qmp_sock_dir = None
+        guest.vm_root_dir = str(tmp_path)
+
+        def on_shutdown():
+            nonlocal shutdown_callbacks
+            shutdown_callbacks += 1
+
+        guest.on_shutdown_callback = on_shutdown
+        await guest.shutdown()
+        return guest
+
+    guest = asyncio.run(run())
+    assert shutdown_callbacks == 1
+    assert guest.qemu_process is None
+
+def test_split_lines_keeps_partial_line_until_final():
+    pending = bytearray(b"first\nsecond\nthi")
+    assert _split_lines(pending, final=False) == [b"first", b"second"]
+    assert pending == b"thi"
+
+    pending += b"rd"
+    assert _split_lines(pending, final=True) == [b"third"]
+    assert pending == b""
+
+def test_split_lines_bounds_unterminated_output():
+    pending = bytearray(b"x" * (_STDERR_CHUNK_SIZE + 10))
+    assert _split_lines(pending, final=False) == [b"x" * _STDERR_CHUNK_SIZE]
+    assert len(pending) == 10
+
+def run_health_monitor(data: bytes, level: str = "ERROR") -> tuple[list[str], int]:
+    messages: list[str] = []
+    health_callbacks = 0
+
+    async def run():
+        nonlocal health_callbacks
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+
+        guest = make_guest()
+        guest.qemu_process = SimpleNamespace(stderr=reader, returncode=None) # pyright: ignore[reportAttributeAccessIssue]
+
+        def on_health_degradation():
+            nonlocal health_callbacks
+            health_callbacks += 1
+
+        async def shutdown():
+            guest.qemu_process = None
+
+        guest.on_health_degradation_callback = on_health_degradation
+        guest.shutdown = shutdown # pyright: ignore[reportAttributeAccessIssue]
+        guest._health_monitor = asyncio.create_task(guest._health_monitor_proc())
+        await guest._health_monitor
+
+    sink = logger.add(messages.append, level=level, format="{level}|{message}")
+    try:
+        asyncio.run(run())
+    finally:
+        logger.remove(sink)
+
+    return [message for message in messages if message.startswith("ERROR|")], health_callbacks
+
+def test_health_monitor_clean_exit():
+    errors, health_callbacks = run_health_monitor(b"booting\nstill booting\n")
+    assert errors == []
+    assert health_callbacks == 0
+
+def test_health_monitor_reports_anomaly():
+    errors, health_callbacks = run_health_monitor(b"booting\nqemu: ERROR something broke\nnever read\n")
+    assert len(errors) == 1
+    assert "booting\nqemu: ERROR something broke" in errors[0]
+    assert "never read" not in errors[0]
+    assert health_callbacks == 1
+
+def test_health_monitor_checks_final_unterminated_line():
+    errors, health_callbacks = run_health_monitor(b"hello\nqemu: invalid option")
+    assert len(errors) == 1
+    assert "qemu: invalid option" in errors[0]
+    assert health_callbacks == 1
+
+def test_health_monitor_traces_undecodable_output():
+    # A multi-byte sequence cut in half must not kill the monitor when TRACE logging decodes it
+    errors, health_callbacks = run_health_monitor(b"caf\xc3\nbooting\n", level="TRACE")
+    assert errors == []
+    assert health_callbacks == 0